@@ -520,8 +520,8 @@ class BertModel(BertPreTrainedModel):
         device = input_ids.device
 
         if attention_mask is None:
-            attention_mask = torch.ones(input_shape, device=device)
-            attention_mask[input_ids==PAD_ID] = 0
+            # return_extended_attention_mask casts the bool mask to the parameter dtype
+            attention_mask = (input_ids != PAD_ID)
 
         token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
 
@@ -675,7 +675,7 @@ class BertForMaskedLM(BertPreTrainedModel):
         sco_loss = self.guide_layer(outputs_src, outputs_tgt, inputs_src, inputs_tgt, guide=guide, extraction=extraction, softmax_threshold=softmax_threshold, train_so=train_so, train_co=train_co)
         return sco_loss
 
-    def get_aligned_word(self, inputs_src, inputs_tgt, bpe2word_map_src, bpe2word_map_tgt, device, src_len, tgt_len, align_layer=8, extraction='softmax', softmax_threshold=0.001, test=False, output_prob=False, word_aligns=None):
+    def get_aligned_word(self, inputs_src, inputs_tgt, bpe2word_map_src, bpe2word_map_tgt, device, src_len, tgt_len, align_layer=8, extraction='softmax', softmax_threshold=0.001, test=False, output_prob=False, word_aligns=None, encoder=None):
         batch_size = inputs_src.size(0)
         bpelen_src, bpelen_tgt = inputs_src.size(1)-2, inputs_tgt.size(1)-2
         if word_aligns is None:
@@ -683,16 +683,21 @@ class BertForMaskedLM(BertPreTrainedModel):
             inputs_tgt = inputs_tgt.to(dtype=torch.long, device=device).clone()
 
             with torch.no_grad():
-                outputs_src = self.bert(
-                    inputs_src,
-                    align_layer=align_layer,
-                    attention_mask=(inputs_src!=PAD_ID),
-                )
-                outputs_tgt = self.bert(
-                    inputs_tgt,
-                    align_layer=align_layer,
-                    attention_mask=(inputs_tgt!=PAD_ID),
-                )
+                if encoder is None:
+                    outputs_src = self.bert(
+                        inputs_src,
+                        align_layer=align_layer,
+                        attention_mask=(inputs_src!=PAD_ID),
+                    )
+                    outputs_tgt = self.bert(
+                        inputs_tgt,
+                        align_layer=align_layer,
+                        attention_mask=(inputs_tgt!=PAD_ID),
+                    )
+                else:
+                    # encoder(input_ids, attention_mask) stands in for the first align_layer layers of self.bert
+                    outputs_src = encoder(inputs_src, (inputs_src!=PAD_ID))
+                    outputs_tgt = encoder(inputs_tgt, (inputs_tgt!=PAD_ID))
 
                 attention_probs_inter = self.guide_layer(outputs_src, outputs_tgt, inputs_src, inputs_tgt, extraction=extraction, softmax_threshold=softmax_threshold, output_prob=output_prob)
                 if output_prob:
@@ -701,15 +706,20 @@ class BertForMaskedLM(BertPreTrainedModel):
                 attention_probs_inter = attention_probs_inter.float()
                 
             word_aligns = []
-            attention_probs_inter = attention_probs_inter[:, 0, 1:-1, 1:-1]
+            # copy to the host once instead of syncing with the device for every aligned pair
+            attention_probs_inter = attention_probs_inter[:, 0, 1:-1, 1:-1].cpu()
+            if output_prob:
+                alignment_probs = alignment_probs.float().cpu()
 
             for idx, (attention, b2w_src, b2w_tgt) in enumerate(zip(attention_probs_inter, bpe2word_map_src, bpe2word_map_tgt)):
                 aligns = set() if not output_prob else dict()
-                non_zeros = torch.nonzero(attention)
-                for i, j in non_zeros:
+                non_zeros = torch.nonzero(attention, as_tuple=True)
+                if output_prob:
+                    probs = alignment_probs[idx][non_zeros].tolist()
+                for k, (i, j) in enumerate(zip(non_zeros[0].tolist(), non_zeros[1].tolist())):
                     word_pair = (b2w_src[i], b2w_tgt[j])
                     if output_prob:
-                        prob = alignment_probs[idx, i, j] 
+                        prob = probs[k]
                         if not word_pair in aligns:
                             aligns[word_pair] = prob
                         else:
@@ -17,11 +17,16 @@
 
 
 import argparse
+import collections
+import functools
+import heapq
 import random
 import itertools
+import mmap
 import os
 import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -44,6 +49,13 @@ def set_seed(args):
         torch.manual_seed(args.seed)
         torch.cuda.manual_seed_all(args.seed)
 
+@functools.lru_cache(maxsize=1 << 20)
+def _tok_word(tokenizer, word):
+    # words follow a Zipfian distribution, so most lookups hit the cache; each
+    # DataLoader worker process keeps its own copy
+    toks = tokenizer.tokenize(word)
+    return toks, tokenizer.convert_tokens_to_ids(toks)
+
 class LineByLineTextDataset(IterableDataset):
     def __init__(self, tokenizer: PreTrainedTokenizer, file_path, offsets=None):
         assert os.path.isfile(file_path)
@@ -52,30 +64,39 @@ class LineByLineTextDataset(IterableDataset):
         self.tokenizer = tokenizer
         self.file_path = file_path
         self.offsets = offsets
+        self.cls_id, self.sep_id, self.max_len = tokenizer.cls_token_id, tokenizer.sep_token_id, tokenizer.max_len
+
+    def word_pieces(self, words):
+        # one pass over the words: the flattened word-piece ids and the word index of each piece
+        wids, bpe2word_map = [], []
+        for i, word in enumerate(words):
+            ids = _tok_word(self.tokenizer, word)[1]
+            wids.extend(ids)
+            bpe2word_map.extend([i] * len(ids))
+        return wids, bpe2word_map
 
     def process_line(self, worker_id, line):
-        if len(line) == 0 or line.isspace() or not len(line.split(' ||| ')) == 2:
+        # line holds the raw bytes of one input line; only its two halves are decoded
+        if len(line) == 0 or line.isspace():
+            return None
+        parts = line.split(b' ||| ')
+        if len(parts) != 2:
             return None
 
-        src, tgt = line.split(' ||| ')
-        if src.rstrip() == '' or tgt.rstrip() == '':
+        # split() already drops surrounding whitespace (including a trailing '\r')
+        sent_src, sent_tgt = parts[0].decode('utf-8').split(), parts[1].decode('utf-8').split()
+        if not sent_src or not sent_tgt:
             return None
 
-        sent_src, sent_tgt = src.strip().split(), tgt.strip().split()
-        token_src, token_tgt = [self.tokenizer.tokenize(word) for word in sent_src], [self.tokenizer.tokenize(word) for word in sent_tgt]
-        wid_src, wid_tgt = [self.tokenizer.convert_tokens_to_ids(x) for x in token_src], [self.tokenizer.convert_tokens_to_ids(x) for x in token_tgt]
+        wid_src, bpe2word_map_src = self.word_pieces(sent_src)
+        wid_tgt, bpe2word_map_tgt = self.word_pieces(sent_tgt)
 
-        ids_src, ids_tgt = self.tokenizer.prepare_for_model(list(itertools.chain(*wid_src)), return_tensors='pt', max_length=self.tokenizer.max_len)['input_ids'], self.tokenizer.prepare_for_model(list(itertools.chain(*wid_tgt)), return_tensors='pt', max_length=self.tokenizer.max_len)['input_ids']
-        if len(ids_src[0]) == 2 or len(ids_tgt[0]) == 2:
+        # same as prepare_for_model: truncate to max_len including [CLS] and [SEP]
+        wid_src, wid_tgt = wid_src[:self.max_len-2], wid_tgt[:self.max_len-2]
+        if len(wid_src) == 0 or len(wid_tgt) == 0:
             return None
-
-        bpe2word_map_src = []
-        for i, word_list in enumerate(token_src):
-            bpe2word_map_src += [i for x in word_list]
-        bpe2word_map_tgt = []
-        for i, word_list in enumerate(token_tgt):
-            bpe2word_map_tgt += [i for x in word_list]
-        return (worker_id, ids_src[0], ids_tgt[0], bpe2word_map_src, bpe2word_map_tgt, sent_src, sent_tgt)
+        ids_src, ids_tgt = torch.tensor([self.cls_id] + wid_src + [self.sep_id]), torch.tensor([self.cls_id] + wid_tgt + [self.sep_id])
+        return (worker_id, ids_src, ids_tgt, bpe2word_map_src, bpe2word_map_tgt, sent_src, sent_tgt)
 
     def __iter__(self):
         if self.offsets is not None:
@@ -88,62 +109,219 @@ class LineByLineTextDataset(IterableDataset):
             offset_end = None
             worker_id = 0
 
-        with open(self.file_path, encoding="utf-8") as f:
-            f.seek(offset_start)
-            line = f.readline()
-            while line:
-                processed = self.process_line(worker_id, line)
-                if processed is None:
-                    print(f'Line "{line.strip()}" (offset in bytes: {f.tell()}) is not in the correct format. Skipping...')
-                    empty_tensor = torch.tensor([self.tokenizer.cls_token_id, 999, self.tokenizer.sep_token_id])
-                    empty_sent = ''
-                    yield (worker_id, empty_tensor, empty_tensor, [-1], [-1], empty_sent, empty_sent)
-                else:
-                    yield processed
-                if offset_end is not None and f.tell() >= offset_end:
-                    break
-                line = f.readline()
+        with open(self.file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if offset_end is None:
+                offset_end = size
+            # offsets are line starts, so an empty range has no lines (mmap also rejects empty files)
+            if offset_start >= offset_end:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = offset_start
+                while pos < offset_end:
+                    nl = mm.find(b'\n', pos)
+                    if nl < 0:
+                        nl = size
+                    line = mm[pos:nl]
+                    pos = nl + 1
+                    processed = self.process_line(worker_id, line)
+                    if processed is None:
+                        print(f'Line "{line.decode("utf-8", errors="replace").strip()}" (offset in bytes: {min(pos, size)}) is not in the correct format. Skipping...')
+                        empty_tensor = torch.tensor([self.cls_id, 999, self.sep_id])
+                        empty_sent = ''
+                        yield (worker_id, empty_tensor, empty_tensor, [-1], [-1], empty_sent, empty_sent)
+                    else:
+                        yield processed
+
+class BucketIterableDataset(IterableDataset):
+    """Groups examples of similar length into minibatches to reduce padding.
+
+    Reads ``batch_size * bucket_mult`` examples at a time, sorts them by length and
+    yields lists of at most ``batch_size`` ``(orig_idx, example)`` pairs, where
+    ``orig_idx`` counts the examples read by the current worker.
+    """
+    def __init__(self, dataset, batch_size, bucket_mult=50):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * max(1, bucket_mult)
+
+    def sorted_batches(self, bucket):
+        bucket.sort(key=lambda x: max(len(x[1][1]), len(x[1][2])))
+        for i in range(0, len(bucket), self.batch_size):
+            yield bucket[i:i+self.batch_size]
+
+    def __iter__(self):
+        bucket = []
+        for example in enumerate(self.dataset):
+            bucket.append(example)
+            if len(bucket) >= self.bucket_size:
+                yield from self.sorted_batches(bucket)
+                bucket = []
+        if bucket:
+            yield from self.sorted_batches(bucket)
+
+class ReorderBuffer(object):
+    """Releases per-worker results in their original (``orig_idx``) order."""
+    def __init__(self):
+        self.heaps = {}
+        self.next_idx = {}
+
+    def push(self, worker_id, idx, item):
+        heap = self.heaps.setdefault(worker_id, [])
+        heapq.heappush(heap, (idx, item))
+        next_idx = self.next_idx.get(worker_id, 0)
+        ready = []
+        while heap and heap[0][0] == next_idx:
+            ready.append(heapq.heappop(heap)[1])
+            next_idx += 1
+        self.next_idx[worker_id] = next_idx
+        return ready
 
 def find_offsets(filename, num_workers):
     if num_workers <= 1:
         return None
-    with open(filename, "r", encoding="utf-8") as f:
+    # b'\n' never occurs inside a multi-byte UTF-8 sequence, so no decoding is needed
+    with open(filename, "rb") as f:
         size = os.fstat(f.fileno()).st_size
-        chunk_size = size // num_workers
         offsets = [0]
         for i in range(1, num_workers):
-            f.seek(chunk_size * i)
-            pos = f.tell()
+            pos = size * i // num_workers
+            f.seek(pos)
             while True:
-                try:
-                    l=f.readline()
+                buf = f.read(1 << 16)
+                if not buf:
+                    pos = size
+                    break
+                nl = buf.find(b'\n')
+                if nl >= 0:
+                    pos += nl + 1
                     break
-                except UnicodeDecodeError:
-                    pos -= 1
-                    f.seek(pos)
-            offsets.append(f.tell())
+                pos += len(buf)
+            offsets.append(pos)
     return offsets
 
-def open_writer_list(filename, num_workers):
+class LineBufferedWriter(object):
+    """Collects output lines in memory and writes them to ``file`` in chunks."""
+    def __init__(self, file, flush_lines=256):
+        self.file = file
+        self.flush_lines = flush_lines
+        self.lines = []
+
+    def write_line(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.flush_lines:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.lines.append('')
+            self.file.write('\n'.join(self.lines))
+            self.lines = []
+
+def open_writer_list(filename, num_workers, flush_lines=256):
     writer = open(filename, 'w+', encoding='utf-8')
     writers = [writer]
     if num_workers > 1:
-        writers.extend([tempfile.TemporaryFile(mode='w+', encoding='utf-8') for i in range(1, num_workers)])
-    return writers
+        writers.extend([tempfile.TemporaryFile(mode='w+', buffering=1 << 20, encoding='utf-8') for i in range(1, num_workers)])
+    return [LineBufferedWriter(writer, flush_lines) for writer in writers]
 
 def merge_files(writers):
+    for writer in writers:
+        writer.flush()
+    writers = [writer.file for writer in writers]
     if len(writers) == 1:
         writers[0].close()
         return
 
     for i, writer in enumerate(writers[1:], 1):
-        writer.seek(0)
-        shutil.copyfileobj(writer, writers[0])
+        # sendfile writes at the fd's position, so the previous copyfileobj tail must be flushed first
+        writers[0].flush()
+        writer.flush()
+        size = os.fstat(writer.fileno()).st_size
+        offset = 0
+        try:
+            # zero-copy in the kernel on Linux
+            while offset < size:
+                sent = os.sendfile(writers[0].fileno(), writer.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except (OSError, AttributeError):
+            pass
+        if offset < size:
+            # no (working) sendfile: copy the rest in large chunks, after syncing the
+            # destination's position with whatever sendfile already appended
+            writers[0].seek(0, os.SEEK_END)
+            writer.buffer.seek(offset)
+            shutil.copyfileobj(writer.buffer, writers[0].buffer, 1 << 20)
         writer.close()
     writers[0].close()
     return
 
 
+def prefetch_to_device(batches, device):
+    """Copies the tensors of each batch to ``device`` one batch ahead, on a side CUDA stream.
+
+    With pinned batches the copy of the next batch overlaps the forward pass of the current one.
+    """
+    if device.type != 'cuda':
+        yield from batches
+        return
+
+    stream = torch.cuda.Stream(device)
+    def copy(batch):
+        with torch.cuda.stream(stream):
+            batch = tuple(x.to(device, non_blocking=True) if torch.is_tensor(x) else x for x in batch)
+            copied = torch.cuda.Event()
+            copied.record(stream)
+        return batch, copied
+
+    def ready(pending):
+        batch, copied = pending
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_event(copied)
+        for x in batch:
+            if torch.is_tensor(x):
+                # the tensors were allocated on the side stream but are used on the current one
+                x.record_stream(current_stream)
+        return batch
+
+    pending = None
+    for batch in batches:
+        batch = copy(batch)
+        if pending is not None:
+            yield ready(pending)
+        pending = batch
+    if pending is not None:
+        yield ready(pending)
+
+
+def autocast_encoder(encoder, device_type, dtype):
+    """Runs ``encoder`` under autocast and hands back fp32 hidden states.
+
+    Only the encoder runs in half precision: the guide head's src x tgt scores are unscaled
+    dot products in the hundreds, where fp16/bf16 rounding would move pairs across
+    softmax_threshold.
+    """
+    def run(ids, attention_mask):
+        with torch.autocast(device_type=device_type, dtype=dtype):
+            hidden_states = encoder(ids, attention_mask)
+        return hidden_states.float()
+    return run
+
+def _write_results(idxs, worker_ids, word_aligns_list, sents_src, sents_tgt, reorder, writers, prob_writers=None, word_writers=None):
+    for idx, worker_id, word_aligns, sent_src, sent_tgt in zip(idxs, worker_ids, word_aligns_list, sents_src, sents_tgt):
+        pairs = [word_align for word_align in word_aligns if word_align[0] != -1]
+        output = (' '.join([f'{i}-{j}' for i, j in pairs]),
+                  ' '.join([f'{word_aligns[word_align]}' for word_align in pairs]) if prob_writers is not None else None,
+                  ' '.join([f'{sent_src[i]}<sep>{sent_tgt[j]}' for i, j in pairs]) if word_writers is not None else None)
+        for output_line, output_prob_line, output_word_line in reorder.push(worker_id, idx, output):
+            writers[worker_id].write_line(output_line)
+            if prob_writers is not None:
+                prob_writers[worker_id].write_line(output_prob_line)
+            if word_writers is not None:
+                word_writers[worker_id].write_line(output_word_line)
+
 def word_align(args, model: PreTrainedModel, tokenizer: PreTrainedTokenizer):
 
     if args.data_file is None:
@@ -152,55 +330,84 @@ def word_align(args, model: PreTrainedModel, tokenizer: PreTrainedTokenizer):
         return
 
     def collate(examples):
+        idxs, examples = zip(*examples)
         worker_ids, ids_src, ids_tgt, bpe2word_map_src, bpe2word_map_tgt, sents_src, sents_tgt = zip(*examples)
         ids_src = pad_sequence(ids_src, batch_first=True, padding_value=tokenizer.pad_token_id)
         ids_tgt = pad_sequence(ids_tgt, batch_first=True, padding_value=tokenizer.pad_token_id)
-        return worker_ids, ids_src, ids_tgt, bpe2word_map_src, bpe2word_map_tgt, sents_src, sents_tgt
+        return idxs, worker_ids, ids_src, ids_tgt, bpe2word_map_src, bpe2word_map_tgt, sents_src, sents_tgt
 
     offsets = find_offsets(args.data_file, args.num_workers)
     dataset = LineByLineTextDataset(tokenizer, file_path=args.data_file, offsets=offsets)
+    dataset = BucketIterableDataset(dataset, args.batch_size, bucket_mult=args.bucket_mult)
+    # batches are formed by BucketIterableDataset, so disable automatic batching
+    loader_kwargs = {'prefetch_factor': 4} if args.num_workers > 0 else {}
     dataloader = DataLoader(
-        dataset, batch_size=args.batch_size, collate_fn=collate, num_workers=args.num_workers
+        dataset, batch_size=None, collate_fn=collate, num_workers=args.num_workers,
+        pin_memory=(args.device.type == 'cuda'), **loader_kwargs
     )
 
-    model.to(args.device)
+    # only the first align_layer layers are used, so free the rest before moving to the device
+    export = ExportNthLayer(model, args.align_layer, prune=True)
     model.eval()
+    if args.use_onnx:
+        # onnxruntime holds the encoder weights; the guide head left in torch has no
+        # parameters, so the torch model stays on the host
+        encoder = OnnxEncoder(args.onnx_model, args.device, model.config.hidden_size, tensorrt=(args.quantize == 'static'))
+    else:
+        model.to(args.device)
+        dtype = torch.float32
+        if args.fp16:
+            if args.device.type == 'cuda':
+                dtype = torch.float16
+            else:
+                print('--fp16 requires CUDA, running in fp32 (try --bf16 on CPU)')
+        elif args.bf16:
+            dtype = torch.bfloat16
+        if dtype != torch.float32:
+            model.to(dtype)
+        if args.torch_compile:
+            encoder = compile_encoder(export, args)
+        elif args.bettertransformer:
+            encoder = FastpathEncoder(export)
+        else:
+            # the same layers as model.bert, but with the bool mask, the cached token_type_ids
+            # and no mask add for batches without padding
+            encoder = export
+        if dtype != torch.float32:
+            encoder = autocast_encoder(encoder, args.device.type, dtype)
     tqdm_iterator = trange(0, desc="Extracting")
 
-    writers = open_writer_list(args.output_file, args.num_workers)
+    flush_lines = args.batch_size * 8
+    writers = open_writer_list(args.output_file, args.num_workers, flush_lines)
+    prob_writers, word_writers = None, None
     if args.output_prob_file is not None:
-        prob_writers = open_writer_list(args.output_prob_file, args.num_workers)
+        prob_writers = open_writer_list(args.output_prob_file, args.num_workers, flush_lines)
     if args.output_word_file is not None:
-        word_writers = open_writer_list(args.output_word_file, args.num_workers)
-
-    for batch in dataloader:
-        with torch.no_grad():
-            worker_ids, ids_src, ids_tgt, bpe2word_map_src, bpe2word_map_tgt, sents_src, sents_tgt = batch
-            word_aligns_list = model.get_aligned_word(ids_src, ids_tgt, bpe2word_map_src, bpe2word_map_tgt, args.device, 0, 0, align_layer=args.align_layer, extraction=args.extraction, softmax_threshold=args.softmax_threshold, test=True, output_prob=(args.output_prob_file is not None))
-            for worker_id, word_aligns, sent_src, sent_tgt in zip(worker_ids, word_aligns_list, sents_src, sents_tgt):
-                output_str = []
-                if args.output_prob_file is not None:
-                    output_prob_str = []
-                if args.output_word_file is not None:
-                    output_word_str = []
-                for word_align in word_aligns:
-                    if word_align[0] != -1:
-                        output_str.append(f'{word_align[0]}-{word_align[1]}')
-                        if args.output_prob_file is not None:
-                            output_prob_str.append(f'{word_aligns[word_align]}')
-                        if args.output_word_file is not None:
-                            output_word_str.append(f'{sent_src[word_align[0]]}<sep>{sent_tgt[word_align[1]]}')
-                writers[worker_id].write(' '.join(output_str)+'\n')
-                if args.output_prob_file is not None:
-                    prob_writers[worker_id].write(' '.join(output_prob_str)+'\n')
-                if args.output_word_file is not None:
-                    word_writers[worker_id].write(' '.join(output_word_str)+'\n')
+        word_writers = open_writer_list(args.output_word_file, args.num_workers, flush_lines)
+
+    # batches are sorted by length, so restore the input order before writing
+    reorder = ReorderBuffer()
+    # output lines are built and written on a background thread while the next batch runs;
+    # a single thread keeps submission order, so the reorder buffer and writers need no locks
+    pending = collections.deque()
+    # inference_mode also skips the version counter and view tracking that no_grad keeps
+    with ThreadPoolExecutor(max_workers=1) as pool, torch.inference_mode():
+        for batch in prefetch_to_device(dataloader, args.device):
+            idxs, worker_ids, ids_src, ids_tgt, bpe2word_map_src, bpe2word_map_tgt, sents_src, sents_tgt = batch
+            word_aligns_list = model.get_aligned_word(ids_src, ids_tgt, bpe2word_map_src, bpe2word_map_tgt, args.device, 0, 0, align_layer=args.align_layer, extraction=args.extraction, softmax_threshold=args.softmax_threshold, test=True, output_prob=(args.output_prob_file is not None), encoder=encoder)
+            # keep at most two batches queued for the writer thread
+            if len(pending) >= 2:
+                pending.popleft().result()
+            pending.append(pool.submit(_write_results, idxs, worker_ids, word_aligns_list, sents_src, sents_tgt,
+                                       reorder, writers, prob_writers, word_writers))
             tqdm_iterator.update(len(ids_src))
+        while pending:
+            pending.popleft().result()
 
     merge_files(writers)
-    if args.output_prob_file is not None:
+    if prob_writers is not None:
         merge_files(prob_writers)
-    if args.output_word_file is not None:
+    if word_writers is not None:
         merge_files(word_writers)
 
 def return_extended_attention_mask(attention_mask, dtype):
@@ -212,8 +419,9 @@ def return_extended_attention_mask(attention_mask, dtype):
         raise ValueError(
              "Wrong shape for input_ids or attention_mask"
         )
-    extended_attention_mask = extended_attention_mask.to(dtype=dtype)
-    extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+    # one masked_fill straight into dtype instead of cast, subtract and multiply
+    # (torch.where with two scalar operands needs a newer torch than we require)
+    extended_attention_mask = torch.zeros(extended_attention_mask.shape, dtype=dtype, device=extended_attention_mask.device).masked_fill_(~extended_attention_mask.bool(), -10000.0)
     return extended_attention_mask
 
 def guess_dtype(model):
@@ -224,40 +432,158 @@ def guess_dtype(model):
   else:
     return torch.float32
 
+def _is_tracing():
+  if torch.jit.is_tracing():
+    return True
+  # torch.compiler.is_compiling only exists in recent 2.x releases; earlier ones have torch._dynamo's
+  compiler = getattr(torch, 'compiler', None)
+  if compiler is not None and hasattr(compiler, 'is_compiling'):
+    return compiler.is_compiling()
+  dynamo = getattr(torch, '_dynamo', None)
+  return dynamo is not None and hasattr(dynamo, 'is_compiling') and dynamo.is_compiling()
+
 class ExportNthLayer(torch.nn.Module):
-    def __init__(self, base_model, align_layer_max=8):
+    def __init__(self, base_model, align_layer_max=8, pad_id=None, prune=False):
         super().__init__()
+        # init_model_and_tokenizer sets modeling.PAD_ID from the tokenizer
+        self.pad_id = modeling.PAD_ID if pad_id is None else pad_id
         e = base_model.bert if hasattr(base_model, 'bert') else base_model
         self.bert = e
         self.embeddings = e.embeddings
         # For BERT, num_hidden_layers is in config
         self.config = e.config
-        self.num_layers = min(e.config.num_hidden_layers, align_layer_max)
+        # like BertEncoder, align_layer <= 0 means all layers
+        self.num_layers = e.config.num_hidden_layers if align_layer_max <= 0 else min(e.config.num_hidden_layers, align_layer_max)
         e = e.encoder if hasattr(e, 'encoder') else e
         self.encoder = e
         self.layer = e.layer[:self.num_layers]
-        print(f'{self.layer}')
+        self._token_type_ids = None
+        if prune:
+            self._prune_unused(base_model)
+
+    def _prune_unused(self, base_model):
+      # frees weights alignment extraction never uses: the layers past num_layers, the
+      # pretraining heads and any pooler (this modifies base_model); base_model is not
+      # kept as a submodule, which would prefix every module and exported tensor name
+      del self.encoder.layer[self.num_layers:]
+      for name in ('cls', 'psi_cls'):
+        if hasattr(base_model, name):
+          delattr(base_model, name)
+      if hasattr(self.bert, 'pooler'):
+        del self.bert.pooler
+      if torch.cuda.is_initialized():
+        torch.cuda.empty_cache()
+
+    def token_type_ids(self, shape, device):
+      # always zeros, so hand out a slice of one cached buffer instead of allocating per batch
+      # (but not while tracing, where the buffer would be captured as a fixed-shape constant)
+      if _is_tracing():
+        return torch.zeros(shape, dtype=torch.long, device=device)
+      tti = self._token_type_ids
+      if tti is None or tti.device != device or tti.size(0) < shape[0] or tti.size(1) < shape[1]:
+        size = shape if tti is None else (max(shape[0], tti.size(0)), max(shape[1], tti.size(1)))
+        tti = self._token_type_ids = torch.zeros(size, dtype=torch.long, device=device)
+      return tti[:shape[0], :shape[1]]
+
+    def embed(self, ids, token_type_ids, position_ids=None):
+      # BertEmbeddings.forward, summing into the freshly allocated word embeddings
+      # instead of materializing each intermediate (B, S, H) sum
+      e = self.embeddings
+      if position_ids is None:
+        position_ids = torch.arange(ids.size(1), dtype=torch.long, device=ids.device).unsqueeze(0)
+      hidden_states = e.word_embeddings(ids)
+      hidden_states.add_(e.position_embeddings(position_ids))
+      hidden_states.add_(e.token_type_embeddings(token_type_ids))
+      return e.dropout(e.LayerNorm(hidden_states))
 
     def forward(self, ids, attention_mask=None, position_ids=None):
       shape = ids.size()
-      device = ids.device
+      dtype = guess_dtype(self.bert)
       if attention_mask is None:
-        attention_mask = torch.ones(shape, device=device)
-        attention_mask[ids==0] = 0
-      token_type_ids = torch.zeros(shape, dtype=torch.long, device=device)
+        # return_extended_attention_mask casts the bool mask to dtype
+        attention_mask = (ids != self.pad_id)
+      token_type_ids = self.token_type_ids(shape, ids.device)
 
       # We can provide a self-attention mask of dimensions [batch_size, from_seq_length, to_seq_length]
       # ourselves in which case we just need to make it broadcastable to all heads.
-      extended_attention_mask = return_extended_attention_mask(attention_mask, guess_dtype(self.bert))
-
-      hidden_states = self.embeddings(ids, token_type_ids=token_type_ids, position_ids=position_ids)
-
-      if self.layer is not None:
-        for i, layer in enumerate(self.layer):
-          hidden_states = layer(hidden_states, attention_mask=extended_attention_mask)
-        return hidden_states
+      if attention_mask.device.type == 'cpu' and not _is_tracing() and bool(attention_mask.all()):
+        # no padding (e.g. an equal-length bucket), so skip the mask add in every layer; only
+        # checked on CPU, since on a GPU the check is a device sync costing more than the adds
+        extended_attention_mask = None
       else:
-        return self.bert(ids, attention_mask)
+        extended_attention_mask = return_extended_attention_mask(attention_mask, dtype)
+
+      hidden_states = self.embed(ids, token_type_ids, position_ids=position_ids)
+      for layer in self.layer:
+        hidden_states = layer(hidden_states, attention_mask=extended_attention_mask)
+      return hidden_states
+
+def bert_layer_to_encoder_layer(layer, config):
+  """Builds a torch.nn.TransformerEncoderLayer computing the same function as a BertLayer.
+
+  The feed-forward and LayerNorm modules are shared with ``layer``; the query, key and
+  value projections are packed into in_proj and removed from ``layer``, so the weights are
+  not kept twice (``layer`` can no longer run on its own afterwards).
+  """
+  att = layer.attention
+  weight = att.self.query.weight
+  encoder_layer = torch.nn.TransformerEncoderLayer(
+      config.hidden_size, config.num_attention_heads, dim_feedforward=config.intermediate_size,
+      dropout=0.0, activation='gelu', layer_norm_eps=config.layer_norm_eps, batch_first=True,
+      device=weight.device, dtype=weight.dtype)
+  self_attn = encoder_layer.self_attn
+  with torch.no_grad():
+    self_attn.in_proj_weight.copy_(torch.cat([att.self.query.weight, att.self.key.weight, att.self.value.weight]))
+    self_attn.in_proj_bias.copy_(torch.cat([att.self.query.bias, att.self.key.bias, att.self.value.bias]))
+  del att.self.query, att.self.key, att.self.value
+  self_attn.out_proj.weight = att.output.dense.weight
+  self_attn.out_proj.bias = att.output.dense.bias
+  encoder_layer.norm1 = att.output.LayerNorm
+  encoder_layer.linear1 = layer.intermediate.dense
+  encoder_layer.linear2 = layer.output.dense
+  encoder_layer.norm2 = layer.output.LayerNorm
+  return encoder_layer.eval()
+
+class FastpathEncoder(torch.nn.Module):
+    """ExportNthLayer on top of torch's fused nn.TransformerEncoder (the BetterTransformer fastpath).
+
+    In eval mode without autograd or autocast, nn.TransformerEncoder packs the batch into a
+    nested tensor using the padding mask, so attention and feed-forward skip the PAD positions.
+    PAD positions of the output are zeros.
+    """
+    def __init__(self, export):
+        super().__init__()
+        self.export = export
+        config = self.export.config
+        if config.hidden_act != 'gelu':
+            raise ValueError(f'--bettertransformer requires hidden_act gelu, not {config.hidden_act}')
+        layers = [bert_layer_to_encoder_layer(layer, config) for layer in self.export.layer]
+        # TransformerEncoder deep-copies its layer num_layers times, so build it with one and swap in the converted layers
+        self.transformer = torch.nn.TransformerEncoder(layers[0], 1, enable_nested_tensor=True)
+        self.transformer.layers = torch.nn.ModuleList(layers)
+        self.transformer.num_layers = len(layers)
+        if torch.cuda.is_initialized():
+            torch.cuda.empty_cache()
+        self.eval()
+
+    def forward(self, ids, attention_mask=None, position_ids=None):
+      if attention_mask is None:
+        attention_mask = (ids != self.export.pad_id)
+      hidden_states = self.export.embed(ids, self.export.token_type_ids(ids.size(), ids.device), position_ids=position_ids)
+      # src_key_padding_mask is True at the positions to skip
+      return self.transformer(hidden_states, src_key_padding_mask=~attention_mask.bool())
+
+def compile_encoder(encoder, args):
+    """Fuses the ExportNthLayer stack with torch.compile, or torch.jit.trace before PyTorch 2.0."""
+    if hasattr(torch, 'compile'):
+        # dynamic=True keeps one graph across the varying (batch, length) shapes of
+        # the length-sorted batches instead of recompiling for each of them; the
+        # default mode avoids CUDA graphs, whose static output buffer would be
+        # overwritten by the tgt call while the src output is still in use
+        return torch.compile(encoder, dynamic=True)
+    ids = torch.randint(0, encoder.config.vocab_size, (args.batch_size, 128), device=args.device)
+    with torch.no_grad():
+        return torch.jit.trace(encoder, (ids, torch.ones_like(ids, dtype=torch.bool)), check_trace=False)
 
 def write_onnx_layers(model, onnx_file_path, max_layer=None,
                       inputs=['input_ids', 'attention_mask'],
@@ -278,7 +604,11 @@ def write_onnx_layers(model, onnx_file_path, max_layer=None,
   inputs_ones = tuple(torch.ones(dims) if x != 'input_ids' else torch.randint(0, model.config.vocab_size, dims) for x in inputs)
 
   # TODO: figure out how to do first nth encoder layers for automodel bert?
-  model = ExportNthLayer(model, max_layer) if max_layer is not None else (model.bert if hasattr(model, 'bert') else model)
+  if max_layer is not None:
+    model = ExportNthLayer(model, max_layer)
+    print(f'{model.layer}')
+  else:
+    model = model.bert if hasattr(model, 'bert') else model
   torch.onnx.export(
       model,
       inputs_ones, #(input_ids, attention_mask),
@@ -297,6 +627,93 @@ def write_onnx_layers(model, onnx_file_path, max_layer=None,
   else:
     return f"Model exported to {onnx_file_path}"
 
+class OnnxEncoder(object):
+    """Runs an encoder exported by write_onnx_layers with onnxruntime.
+
+    Called like ExportNthLayer, ``encoder(ids, attention_mask)`` returns the hidden
+    states of the last exported layer as a torch tensor on ``device``.
+    """
+    def __init__(self, onnx_file_path, device, hidden_size,
+                 inputs=['input_ids', 'attention_mask'], output='output', tensorrt=False):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("Please install onnxruntime (or onnxruntime-gpu) to use --use_onnx.")
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.intra_op_num_threads = os.cpu_count()
+        self.device = device
+        self.device_id = (device.index if device.index is not None else torch.cuda.current_device()) if device.type == 'cuda' else 0
+        providers = ['CPUExecutionProvider']
+        if device.type == 'cuda':
+            providers.insert(0, ('CUDAExecutionProvider', {'device_id': self.device_id}))
+            if tensorrt:
+                providers.insert(0, ('TensorrtExecutionProvider', {'device_id': self.device_id, 'trt_int8_enable': True}))
+        self.session = ort.InferenceSession(onnx_file_path, sess_options, providers=providers)
+        self.inputs = inputs
+        self.output = output
+        self.hidden_size = hidden_size
+        self.io_binding = device.type == 'cuda' and 'CUDAExecutionProvider' in self.session.get_providers()
+
+    def __call__(self, ids, attention_mask):
+        # the exported graph takes int64 ids and a float32 mask (see write_onnx_layers)
+        ids = ids.to(dtype=torch.long).contiguous()
+        attention_mask = attention_mask.to(dtype=torch.float32).contiguous()
+        if not self.io_binding:
+            output, = self.session.run([self.output], {self.inputs[0]: ids.cpu().numpy(), self.inputs[1]: attention_mask.cpu().numpy()})
+            return torch.from_numpy(output).to(self.device)
+
+        # bind the torch CUDA buffers directly so nothing is copied through the host
+        output = torch.empty(tuple(ids.shape) + (self.hidden_size,), dtype=torch.float32, device=ids.device)
+        binding = self.session.io_binding()
+        for name, tensor, element_type in ((self.inputs[0], ids, np.int64), (self.inputs[1], attention_mask, np.float32)):
+            binding.bind_input(name=name, device_type='cuda', device_id=self.device_id, element_type=element_type,
+                               shape=tuple(tensor.shape), buffer_ptr=tensor.data_ptr())
+        binding.bind_output(name=self.output, device_type='cuda', device_id=self.device_id, element_type=np.float32,
+                            shape=tuple(output.shape), buffer_ptr=output.data_ptr())
+        # onnxruntime does not wait on the torch stream that produced the inputs
+        torch.cuda.current_stream(self.device).synchronize()
+        self.session.run_with_iobinding(binding)
+        return output
+
+class OnnxCalibrationReader(object):
+    """Feeds the first lines of a data file to onnxruntime's static quantization calibration."""
+    def __init__(self, dataset, num_lines=64, inputs=['input_ids', 'attention_mask']):
+        self.inputs = inputs
+        examples = itertools.islice(iter(dataset), num_lines)
+        # both sides of each line are run through the same encoder
+        self.ids = (ids for example in examples for ids in (example[1], example[2]))
+
+    def get_next(self):
+        ids = next(self.ids, None)
+        if ids is None:
+            return None
+        ids = ids.unsqueeze(0).numpy()
+        return {self.inputs[0]: ids, self.inputs[1]: np.ones(ids.shape, dtype=np.float32)}
+
+def quantize_onnx(onnx_file_path, mode='dynamic', calibration_reader=None):
+  """Writes an int8 copy of the exported model next to it and returns its path."""
+  try:
+    from onnxruntime.quantization import quantize_dynamic, quantize_static, QuantFormat, QuantType
+  except ImportError:
+    raise ImportError("Please install onnxruntime to use --quantize.")
+  root, ext = os.path.splitext(onnx_file_path)
+  quant_path = root + '.int8' + (ext or '.onnx')
+  # the linear layers (MatMul, or Attention once fused) are nearly all of the BERT compute
+  op_types = ['MatMul', 'Attention']
+  if mode == 'dynamic':
+    quantize_dynamic(onnx_file_path, quant_path, op_types_to_quantize=op_types, weight_type=QuantType.QInt8)
+  elif mode == 'static':
+    if calibration_reader is None:
+      raise ValueError('static quantization needs a calibration_reader')
+    # QDQ models can also be consumed by the TensorRT execution provider
+    quantize_static(onnx_file_path, quant_path, calibration_reader, quant_format=QuantFormat.QDQ,
+                    op_types_to_quantize=op_types, activation_type=QuantType.QInt8, weight_type=QuantType.QInt8)
+  else:
+    raise ValueError(f'unknown quantization mode {mode}')
+  print(f"Quantized model written to {quant_path}")
+  return quant_path
+
 def init_model_and_tokenizer(
     model_name_or_path,
     config_name = None,
@@ -394,9 +811,36 @@ def main():
         default=None,
         help="Limit onnx conversion to this many encoder layers",
     )
+    parser.add_argument(
+        "--use_onnx",
+        action="store_true",
+        help="Extract alignments by running the encoder written to output_onnx with onnxruntime",
+    )
+    parser.add_argument(
+        "--quantize",
+        default='none',
+        choices=['none', 'dynamic', 'static'],
+        help="Also write an int8 quantized copy of output_onnx (and use it with --use_onnx); static calibrates on data_file",
+    )
+    parser.add_argument(
+        "--torch_compile",
+        action="store_true",
+        help="Compile the first align_layer encoder layers with torch.compile (torch.jit.trace before PyTorch 2.0)",
+    )
+    parser.add_argument(
+        "--bettertransformer",
+        action="store_true",
+        help="Run the encoder layers through torch's nn.TransformerEncoder fastpath, which skips PAD positions",
+    )
 
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
     parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument(
+        "--bucket_mult",
+        type=int,
+        default=50,
+        help="Sort each group of batch_size*bucket_mult examples by length before batching to reduce padding",
+    )
     parser.add_argument(
         "--cache_dir",
         default=None,
@@ -404,8 +848,31 @@ def main():
         help="Optional directory to store the pre-trained models downloaded from s3 (instead of the default one)",
     )
     parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
+    precision = parser.add_mutually_exclusive_group()
+    precision.add_argument("--fp16", action="store_true", help="Run alignment extraction in float16 (CUDA only)")
+    precision.add_argument("--bf16", action="store_true", help="Run alignment extraction in bfloat16")
     parser.add_argument("--num_workers", type=int, default=4, help="Number of workers for data loading")
     args = parser.parse_args()
+    if sum([args.use_onnx, args.torch_compile, args.bettertransformer]) > 1:
+        parser.error('--use_onnx, --torch_compile and --bettertransformer are mutually exclusive')
+    if args.bettertransformer:
+        # nn.TransformerEncoder gained enable_nested_tensor and its fastpath in 1.12
+        if tuple(int(v) for v in torch.__version__.split('.')[:2]) < (1, 12):
+            parser.error(f'--bettertransformer requires PyTorch 1.12 or later, not {torch.__version__}')
+        if args.fp16 or args.bf16:
+            parser.error('--bettertransformer cannot be combined with --fp16/--bf16, the fastpath is disabled under autocast')
+    if args.use_onnx:
+        if args.output_onnx is None:
+            parser.error('--use_onnx requires --output_onnx')
+        if args.max_layer is not None and args.max_layer != args.align_layer:
+            parser.error('--use_onnx exports align_layer layers, leave --max_layer unset or equal to --align_layer')
+        if args.fp16 or args.bf16:
+            parser.error('--fp16/--bf16 do not apply to --use_onnx, use --quantize instead')
+        args.max_layer = args.align_layer
+    if args.quantize != 'none' and args.output_onnx is None:
+        parser.error('--quantize requires --output_onnx')
+    if args.quantize == 'static' and args.data_file is None:
+        parser.error('--quantize static calibrates on --data_file')
     device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
     args.device = device
 
@@ -413,8 +880,14 @@ def main():
 
     model, tokenizer = init_model_and_tokenizer(args.model_name_or_path, args.config_name, args.cache_dir, args.tokenizer_name)
 
+    args.onnx_model = args.output_onnx
     if args.output_onnx is not None:
         write_onnx_layers(model, args.output_onnx, max_layer=args.max_layer)
+        if args.quantize != 'none':
+            calibration_reader = None
+            if args.quantize == 'static':
+                calibration_reader = OnnxCalibrationReader(LineByLineTextDataset(tokenizer, file_path=args.data_file))
+            args.onnx_model = quantize_onnx(args.output_onnx, args.quantize, calibration_reader)
 
     word_align(args, model, tokenizer)
 
@@ -5,7 +5,7 @@ setup(
     name='awesome_align',
     install_requires=[
         'tokenizers>=0.5.2',
-        'torch>=1.2.0',
+        'torch>=1.10.0',
         'tqdm',
         'numpy',
         'boto3',